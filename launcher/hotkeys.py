@@ -1,109 +1,264 @@
+import os
 import time
-from typing import Callable
-import pygame
+import evdev
+import select
 import logging
 import threading
 import subprocess
+from typing import Callable
+from evdev import ecodes
 
 
-SELECT = 8
-START = 9
+SELECT = ecodes.BTN_SELECT
+START = ecodes.BTN_START
 HOTKEY = (SELECT, START)
-TICKS_PER_SECOND = 2
-SLEEP_TIME = 1.0 / TICKS_PER_SECOND
-HOTKEY_HOLD_CHECK_TIME = 3 * TICKS_PER_SECOND
-GAMEPAD_REFRESH_TIME = 10 * TICKS_PER_SECOND
+HOTKEY_HOLD_TIME = 3.0
+CHECK_TIME = 0.5
+DEVICES_DIRECTORY = "/dev/input"
 
 
 LOGGER = logging.getLogger("launch-server:hotkeys")
 LOGGER.setLevel(logging.INFO)
 
 
-def _gamepads_pressing_hotkey():
+# The input devices are cached by their path, so they are not
+# opened (and queried) again by each hotkey watcher. Devices not
+# supporting the hotkey are cached as None. The cache is refreshed
+# only when the devices directory changes (i.e. a device is added
+# or removed), and only one watcher may use it at once. Since the
+# kernel reuses the device paths (e.g. a gamepad plugged again gets
+# the same eventN), the identity of each cached device is recorded
+# as well, so a reused path is not mistaken for the old device.
+_GAMEPADS = {}
+_GAMEPADS_IDENTITIES = {}
+_GAMEPADS_MTIME = None
+_GAMEPADS_LOCK = threading.Lock()
+
+
+def _refresh_gamepads():
+    """
+    Opens all the new input devices supporting the hotkey buttons,
+    if the devices directory changed since the last refresh.
+    """
+
+    global _GAMEPADS_MTIME
+
+    try:
+        mtime = os.stat(DEVICES_DIRECTORY).st_mtime_ns
+    except OSError:
+        LOGGER.exception(f"Could not check {DEVICES_DIRECTORY}")
+        return
+    if mtime == _GAMEPADS_MTIME:
+        return
+
+    complete = True
+    paths = evdev.list_devices(DEVICES_DIRECTORY)
+    for path in set(_GAMEPADS) - set(paths):
+        _close_gamepad(path)
+    for path in paths:
+        # Cached devices are kept only while their path still
+        # refers to the same device.
+        if path in _GAMEPADS:
+            try:
+                if _get_identity(os.stat(path)) == _GAMEPADS_IDENTITIES[path]:
+                    continue
+            except OSError:
+                pass
+            _close_gamepad(path)
+
+        # Only devices having both the SELECT and START buttons
+        # are considered. The others are discarded immediately.
+        device = None
+        try:
+            device = evdev.InputDevice(path)
+            identity = _get_identity(os.fstat(device.fd))
+            keys = device.capabilities().get(ecodes.EV_KEY, [])
+        except OSError:
+            # It will be attempted again in the next refresh.
+            if device:
+                device.close()
+            complete = False
+            continue
+
+        _GAMEPADS_IDENTITIES[path] = identity
+        if SELECT in keys and START in keys:
+            LOGGER.info(f"Watching gamepad: {device.name}")
+            _GAMEPADS[path] = device
+        else:
+            device.close()
+            _GAMEPADS[path] = None
+
+    if complete:
+        _GAMEPADS_MTIME = mtime
+
+
+def _get_identity(stat: os.stat_result):
+    """
+    Tells the identity of a device node, which changes when the
+    device is removed and another one takes the same path.
+    :param stat: The device node's stat.
+    :returns: The device identity.
+    """
+
+    return stat.st_rdev, stat.st_ino
+
+
+def _close_gamepad(path: str):
+    """
+    Closes and forgets a device (e.g. it was disconnected).
+    :param path: The device path.
     """
-    Gets the first gamepad, and also the current hotkey.
 
-    :returns: The list of device NAMES holding the key.
+    _GAMEPADS_IDENTITIES.pop(path, None)
+    device = _GAMEPADS.pop(path, None)
+    if device:
+        try:
+            device.close()
+        except OSError:
+            pass
+
+
+def _get_hotkey_state(device: evdev.InputDevice):
     """
+    Discards the events a gamepad queued while nobody watched it,
+    and tells which hotkey buttons it is currently holding. Raises
+    OSError if the gamepad is not available anymore.
+    :param device: The gamepad.
+    :returns: The hotkey buttons being held, with the current time.
+    """
+
+    try:
+        while list(device.read()):
+            pass
+    except BlockingIOError:
+        pass
 
-    # Process the pygame events.
-    pygame.event.pump()
+    now = time.monotonic()
+    return {key: now for key in device.active_keys() if key in HOTKEY}
 
-    # Iterate over all the joysticks. Inside, check each
-    # one to have the hotkey pressed.
-    joystick_count = pygame.joystick.get_count()
-    ids = []
-    for i in range(joystick_count):
-        joystick = pygame.joystick.Joystick(i)
-        joystick.init()
 
-        # Check whether the joystick is connected. If it is
-        # connected, then check whether it is pressing the
-        # hotkey or not.
-        if joystick.get_init() and joystick.get_numaxes() > 0:
-            if all([joystick.get_button(key) for key in HOTKEY]):
-                ids.append(joystick.get_name())
+def _read_hotkey_events(device: evdev.InputDevice, pressed: dict):
+    """
+    Reads the pending events of a gamepad, and keeps track of the
+    moment each hotkey button started being held.
+    :param device: The gamepad.
+    :param pressed: The hotkey buttons being held for this gamepad.
+    """
 
-    # Return the matched joystick instances.
-    return ids
+    try:
+        events = list(device.read())
+    except BlockingIOError:
+        return
 
+    now = time.monotonic()
+    for event in events:
+        if event.type == ecodes.EV_KEY and (event.code == SELECT or event.code == START):
+            # 0 stands for release, while 1 and 2 stand for press
+            # and auto-repeat respectively.
+            if event.value:
+                pressed.setdefault(event.code, now)
+            else:
+                pressed.pop(event.code, None)
 
-def _is_hotkey_pressed(gamepad, hotkey):
+
+def _open_pidfd(process: subprocess.Popen):
     """
-    Tells whether the hotkey is pressed. By default, the hotkey
-    is START + SELECT.
+    Opens a pidfd for a process. It becomes readable when the process
+    terminates, so it can be waited for along with the gamepads.
+    :param process: The process.
+    :returns: The pidfd, or None if pidfd is not supported.
     """
 
-    pygame.event.pump()
-    return all([gamepad.get_button(key) for key in hotkey])
+    try:
+        return os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        return None
 
 
-def do_on_hotkey(check: Callable[[], bool], callback: Callable[[], None]):
+def do_on_hotkey(process: subprocess.Popen, callback: Callable[[], None]) -> threading.Event:
     """
-    Executes something on hotkey or when a condition stops being met.
-    :param check: The condition to check.
+    Executes something on hotkey, unless the process terminates before.
+    :param process: The process to watch.
     :param callback: The callback on the end.
+    :returns: An event that, when set, stops the watch.
     """
 
+    stop = threading.Event()
+    pidfd = _open_pidfd(process)
+
+    def _alive():
+        # With a pidfd, the termination is noticed by the select()
+        # call below, so there is no need to poll the process.
+        return pidfd is not None or process.poll() is None
+
     def _func():
-        pads = {}
+        held = {}
         LOGGER.info("Starting hotkey-checker thread")
-        while check():
-            # Get all the current keys, and pads that are holding
-            # the termination key.
-            keys = set(pads.keys())
-            LOGGER.info("Getting gamepads pressing the hotkey")
-            holding_pads = _gamepads_pressing_hotkey()
-            if holding_pads:
-                LOGGER.info("Gamepads are: " + ", ".join(holding_pads))
-            # For each identified pad, discard them from the keys
-            # and then increment the current value (starting from
-            # a default of 0) by one for the name of the gamepad.
-            # If a given pad reached HOTKEY_HOLD_CHECK_TIME, then
-            # halt everything.
-            for holding_pad in holding_pads:
-                keys.discard(holding_pad)
-                pads[holding_pad] = pads.get(holding_pad, 0) + 1
-                if pads[holding_pad] >= HOTKEY_HOLD_CHECK_TIME:
-                    LOGGER.info("Finishing hotkey loop")
-                    callback()
-                    return
-            # Otherwise, we continue. First, we remove any key in
-            # that dictionary that did not hold the buttons this
-            # frame. And then, we sleep the given time.
-            for key in keys:
-                pads.pop(key)
-            time.sleep(SLEEP_TIME)
+        try:
+            with _GAMEPADS_LOCK:
+                while not stop.is_set() and _alive():
+                    # Look for new gamepads, if any was connected.
+                    now = time.monotonic()
+                    _refresh_gamepads()
+                    for path in set(held) - set(_GAMEPADS):
+                        held.pop(path)
+                    for path, device in list(_GAMEPADS.items()):
+                        if device and path not in held:
+                            try:
+                                held[path] = _get_hotkey_state(device)
+                            except OSError:
+                                LOGGER.info(f"Gamepad disconnected: {device.name}")
+                                _close_gamepad(path)
+
+                    # For each gamepad holding the whole hotkey, check
+                    # whether it was held long enough since the last of
+                    # the buttons was pressed. If a given pad reached the
+                    # HOTKEY_HOLD_TIME, then halt everything. Otherwise,
+                    # wait no longer than when that would happen.
+                    timeout = CHECK_TIME
+                    for path, pressed in held.items():
+                        if len(pressed) == len(HOTKEY):
+                            remaining = HOTKEY_HOLD_TIME - (now - max(pressed.values()))
+                            if remaining <= 0:
+                                LOGGER.info(f"Gamepad {_GAMEPADS[path].name} held the hotkey. Finishing hotkey loop")
+                                callback()
+                                return
+                            timeout = min(timeout, remaining)
+
+                    # Then, block until any gamepad has events, the process
+                    # terminates, or the timeout is reached, and process
+                    # those events. With nothing to wait for, just wait for
+                    # the timeout or the stop.
+                    waitables = [device for device in _GAMEPADS.values() if device]
+                    if pidfd is not None:
+                        waitables.append(pidfd)
+                    if not waitables:
+                        stop.wait(timeout)
+                        continue
+                    readable, _, _ = select.select(waitables, [], [], timeout)
+                    if pidfd is not None and pidfd in readable:
+                        return
+                    for device in readable:
+                        try:
+                            _read_hotkey_events(device, held[device.path])
+                        except OSError:
+                            LOGGER.info(f"Gamepad disconnected: {device.name}")
+                            held.pop(device.path, None)
+                            _close_gamepad(device.path)
+        finally:
+            if pidfd is not None:
+                os.close(pidfd)
     threading.Thread(target=_func).start()
+    return stop
 
 
-def kill_on_hotkey(process: subprocess.Popen):
+def kill_on_hotkey(process: subprocess.Popen) -> threading.Event:
     """
     Starts a watch over the process. If the process is not killed and the
     main joypad is pressing Start + Select for 3 seconds, then the process
     will be killed (non-gracefully!).
     :param process: The process to watch.
+    :returns: An event that, when set, stops the watch.
     """
 
-    do_on_hotkey(lambda: process.poll() is None,
-                 lambda: process.kill())
+    return do_on_hotkey(process, lambda: process.kill())
@@ -1,17 +1,24 @@
-import re
 import os
 import json
-import pygame
 import logging
-import subprocess
+import threading
 import socketserver
 import traceback
 from . import run_web, run_native
+from .reaper import install_reaper
+from .users import get_group_id
 
 
 MAIN_BINDING = "/run/Hawa/game-launcher.sock"
+MAIN_BINDING_GROUP = "hawalnch"
+MAX_REQUEST_SIZE = 65536
 LOGGER = logging.getLogger("launch-server:main")
 LOGGER.setLevel(logging.INFO)
+ELF_MAGIC = b"\x7fELF"
+SHEBANG = b"#!"
+UTF8_BOM = b"\xef\xbb\xbf"
+HTML_MAGICS = (b"<!doctype", b"<html", b"<?xml")
+HTML_EXTENSIONS = (".html", ".htm")
 
 
 class GameLauncherServer(socketserver.ThreadingUnixStreamServer):
@@ -22,14 +29,12 @@ class GameLauncherServer(socketserver.ThreadingUnixStreamServer):
 
     def __init__(self, server_address, request_handler_class):
         super().__init__(server_address, request_handler_class)
-        self.locked = False
+        self.launch_lock = threading.Lock()
 
     def server_activate(self) -> None:
         super().server_activate()
-        pygame.init()
-        os.system(f"chgrp hawalnch {MAIN_BINDING}")
-        os.system(f"chmod g+rw {MAIN_BINDING}")
-        os.system(f"chmod o-rwx {MAIN_BINDING}")
+        os.chown(MAIN_BINDING, -1, get_group_id(MAIN_BINDING_GROUP))
+        os.chmod(MAIN_BINDING, 0o660)
 
 
 class GameLauncherRequestHandler(socketserver.StreamRequestHandler):
@@ -47,16 +52,11 @@ class GameLauncherRequestHandler(socketserver.StreamRequestHandler):
         :return: A (package, app, directory, command) tuple.
         """
 
-        # Read the JSON payload from the socket.
-        payload = b""
-        while True:
-            data = self.request.recv(1024)
-            if not data:
-                break
-            payload += data
-            if b"\n" in payload:
-                payload = payload[:payload.index(b"\n")]
-                break
+        # Read the JSON payload from the socket. Payloads longer
+        # than MAX_REQUEST_SIZE are rejected.
+        payload = self.rfile.readline(MAX_REQUEST_SIZE + 1)
+        if len(payload) > MAX_REQUEST_SIZE:
+            raise ValueError("The request is too long")
 
         # Extract the fields and return them.
         obj = json.loads(payload.strip().decode("utf-8"))
@@ -67,15 +67,23 @@ class GameLauncherRequestHandler(socketserver.StreamRequestHandler):
         Tells whether the executable is an HTML page (returns "web") or another type.
         This "another type" might be an ELF 32-bit or ELF 64-bit, or a shell script,
         but in any case the command type will be the same for them (returns "exe").
+        Only the first bytes of the file are read to tell this.
         :returns: The type: "web" or "exe".
         """
 
-        output = subprocess.check_output(["file", command_path], cwd=real_directory_path).decode('utf-8')
-        LOGGER.info(f"The command ({command_path}) file type is: {output}")
-        if re.search(r"HTML document", output):
-            return "web"
+        with open(os.path.join(real_directory_path, command_path), "rb") as f:
+            head = f.read(512)
+
+        if head.startswith(ELF_MAGIC) or head.startswith(SHEBANG):
+            executable_type = "exe"
+        elif head.removeprefix(UTF8_BOM).lstrip().lower().startswith(HTML_MAGICS):
+            executable_type = "web"
+        elif command_path.lower().endswith(HTML_EXTENSIONS):
+            executable_type = "web"
         else:
-            return "exe"
+            executable_type = "exe"
+        LOGGER.info(f"The command ({command_path}) file type is: {executable_type}")
+        return executable_type
 
     def handle(self):
         """
@@ -141,25 +149,31 @@ class GameLauncherRequestHandler(socketserver.StreamRequestHandler):
 
         # 1. Lock test-and-set.
         assert isinstance(self.server, GameLauncherServer)
-        if self.server.locked:
+        if not self.server.launch_lock.acquire(blocking=False):
             self._send_response({"status": "error", "hint": "command:game-already-running"})
             return
-        self.server.locked = True
 
-        # 2. Determining format.
-        format = self._get_executable_type(real_directory_path, real_relative_command_path)
+        # The lock is released when the game terminates in any way,
+        # or when it could not be launched at all.
+        released = threading.Event()
 
-        # 3. Launching the game. Passing a callback to it, to handle
-        #    termination in any way.
         def _release():
-            self.server.locked = False
+            if not released.is_set():
+                released.set()
+                self.server.launch_lock.release()
 
         try:
-            if format != "web":
+            # 2. Determining format.
+            executable_type = self._get_executable_type(real_directory_path, real_relative_command_path)
+
+            # 3. Launching the game. Passing a callback to it, to handle
+            #    termination in any way.
+            if executable_type != "web":
                 run_native.run_game(real_directory_path, real_relative_command_path, package, app, _release)
             else:
                 run_web.run_game(real_directory_path, real_relative_command_path, package, app, _release)
         except Exception as e:
+            _release()
             self._send_response({"status": "error", "hint": "unknown", "type": type(e).__name__,
                                  "traceback": traceback.format_exc()})
 
@@ -169,6 +183,11 @@ def launch_main_server():
     Launches the server using the main binding.
     """
 
-    os.system(f"rm {MAIN_BINDING}")
+    install_reaper()
+    os.makedirs(os.path.dirname(MAIN_BINDING), exist_ok=True)
+    try:
+        os.unlink(MAIN_BINDING)
+    except FileNotFoundError:
+        pass
     with GameLauncherServer(MAIN_BINDING, GameLauncherRequestHandler) as f:
         f.serve_forever()
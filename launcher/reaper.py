@@ -0,0 +1,160 @@
+import os
+import signal
+import logging
+import selectors
+import threading
+import subprocess
+from typing import Callable
+
+
+LOGGER = logging.getLogger("launch-server:reaper")
+LOGGER.setLevel(logging.INFO)
+
+
+# The watched processes are tracked through their pidfd, which is
+# registered in a single selector (epoll) serviced by one reactor
+# thread for the whole launcher. The pidfd becomes readable when the
+# process terminates.
+_SELECTOR = selectors.DefaultSelector()
+_REACTOR = None
+_REACTOR_LOCK = threading.Lock()
+
+
+# When pidfd is not supported (e.g. kernels before 5.3), these are the
+# processes being watched, by their pid, along with the callbacks to
+# invoke when they terminate. They are all checked by the reactor
+# whenever a SIGCHLD is received (the handler only writes to the
+# wakeup pipe, which is registered in the selector), and also every
+# RECHECK_TIME seconds: a termination might be reaped elsewhere (e.g.
+# by a concurrent poll() call) and then no SIGCHLD would announce it.
+_WATCHED = {}
+_WAKEUP_READ, _WAKEUP_WRITE = os.pipe()
+os.set_blocking(_WAKEUP_READ, False)
+os.set_blocking(_WAKEUP_WRITE, False)
+RECHECK_TIME = 1.0
+
+
+def _run_callback(pid: int, callback: Callable[[], None]):
+    """
+    Invokes the callback for a terminated process. It never raises.
+    :param pid: The process id.
+    :param callback: The callback.
+    """
+
+    try:
+        callback()
+    except Exception:
+        LOGGER.exception(f"An error occurred while cleaning up process {pid}")
+
+
+def _run_reactor():
+    """
+    Waits for the watched processes to terminate, and invokes their
+    callbacks.
+    """
+
+    while True:
+        for key, _ in _SELECTOR.select(RECHECK_TIME if _WATCHED else None):
+            if key.fd == _WAKEUP_READ:
+                _drain_wakeup()
+                continue
+
+            _SELECTOR.unregister(key.fd)
+            os.close(key.fd)
+            process, callback = key.data
+            process.poll()
+            _run_callback(process.pid, callback)
+        _reap()
+
+
+def _drain_wakeup():
+    """
+    Discards the pending wakeups of the reactor.
+    """
+
+    try:
+        while os.read(_WAKEUP_READ, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+def _wake_reactor():
+    """
+    Wakes the reactor up, so it checks the watched processes.
+    """
+
+    try:
+        os.write(_WAKEUP_WRITE, b"\0")
+    except BlockingIOError:
+        # The pipe is full: a wakeup is already pending.
+        pass
+
+
+def _start_reactor():
+    """
+    Starts the reactor thread, unless it is already running.
+    """
+
+    global _REACTOR
+
+    with _REACTOR_LOCK:
+        if _REACTOR is None:
+            _SELECTOR.register(_WAKEUP_READ, selectors.EVENT_READ)
+            _REACTOR = threading.Thread(target=_run_reactor, daemon=True)
+            _REACTOR.start()
+
+
+def _reap():
+    """
+    Invokes the callback of each watched process that terminated.
+    This is invoked from the reactor thread.
+    """
+
+    for pid, (process, callback) in list(_WATCHED.items()):
+        if process.poll() is None or _WATCHED.pop(pid, None) is None:
+            continue
+
+        _run_callback(pid, callback)
+
+
+def install_reaper():
+    """
+    Installs the SIGCHLD handler, for when pidfd is not supported.
+    The handler does nothing by itself: the signal just makes Python
+    write to the wakeup pipe, so the reactor checks the processes.
+    This must be invoked from the main thread, before any process
+    is watched.
+    """
+
+    signal.set_wakeup_fd(_WAKEUP_WRITE)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+
+
+def on_exit(process: subprocess.Popen, callback: Callable[[], None]):
+    """
+    Watches a process and invokes a callback when it terminates.
+    :param process: The process to watch.
+    :param callback: What happens when the process terminates.
+    """
+
+    try:
+        fd = os.pidfd_open(process.pid)
+    except (AttributeError, OSError):
+        # Either pidfd is not supported, or the process is already
+        # gone. Rely on SIGCHLD, but have the reactor check right now
+        # in case it terminated before being watched.
+        _WATCHED[process.pid] = (process, callback)
+        _start_reactor()
+        _wake_reactor()
+        return
+
+    # The process might have been reaped (e.g. by a poll() call
+    # elsewhere) before the pidfd was opened.
+    if process.poll() is not None:
+        os.close(fd)
+        _run_callback(process.pid, callback)
+        return
+
+    _start_reactor()
+    _SELECTOR.register(fd, selectors.EVENT_READ, (process, callback))
@@ -1,16 +1,88 @@
 import os
+import signal
+import shutil
 import logging
 import subprocess
-import threading
 from typing import Callable
+from functools import lru_cache
 from .hotkeys import do_on_hotkey
+from .reaper import on_exit
 from .saves import load_dragonshark_save, store_dragonshark_save
+from .users import get_user_id
 
 
 LOGGER = logging.getLogger("launch-server:run-native")
 LOGGER.setLevel(logging.INFO)
 
 
+# The external commands are resolved once, so launching them does
+# not need to walk the PATH (which might not even be set).
+SUDO = shutil.which("sudo") or "/usr/bin/sudo"
+XHOST = shutil.which("xhost") or "/usr/bin/xhost"
+CRONTAB = shutil.which("crontab") or "/usr/bin/crontab"
+ATRM = shutil.which("atrm") or "/usr/bin/atrm"
+
+
+# These commands clear any pending crontab/atrm entries of the
+# "gamer" user. They are independent, so they run concurrently.
+CLEANUP_COMMANDS = ([CRONTAB, "-u", "gamer", "-r"], [ATRM, "-u", "gamer"])
+
+
+# Only these variables are inherited by the games from the launcher's
+# environment (when present). The rest of it is not passed along.
+GAME_ENV_KEYS = ("PATH", "HOME", "LANG", "TERM")
+
+
+# The "gamer" user's access to the X server persists while it
+# runs, so it only needs to be granted once (successfully).
+_X_ACCESS_GRANTED = False
+
+
+def _kill_user_processes(username: str):
+    """
+    Kills (non-gracefully!) all the processes owned by a user. This
+    is done by walking /proc directly instead of invoking pkill.
+    :param username: The user whose processes will be killed.
+    """
+
+    uid = get_user_id(username)
+    with os.scandir("/proc") as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            try:
+                if entry.stat().st_uid == uid:
+                    os.kill(int(entry.name), signal.SIGKILL)
+            except (FileNotFoundError, ProcessLookupError):
+                continue
+
+
+def _grant_x_access():
+    """
+    Grants the "gamer" user access to the X server, unless it was
+    already granted.
+    """
+
+    global _X_ACCESS_GRANTED
+
+    if not _X_ACCESS_GRANTED:
+        _X_ACCESS_GRANTED = subprocess.run([SUDO, XHOST, "+si:localuser:gamer"]).returncode == 0
+
+
+@lru_cache(maxsize=1)
+def _get_game_env():
+    """
+    Builds the environment for the games, with only the variables they
+    need. It is built only once, since it does not change between
+    launches. It must not be modified.
+    :return: The environment.
+    """
+
+    env = {key: os.environ[key] for key in GAME_ENV_KEYS if key in os.environ}
+    env.update(DISPLAY=":0", XAUTHORITY="/home/gamer/.Xauthority")
+    return env
+
+
 def run_game(directory: str, command: str, package: str, app: str, on_end: Callable[[], None]):
     """
     Executes a native game.
@@ -28,28 +100,31 @@ def run_game(directory: str, command: str, package: str, app: str, on_end: Calla
 
     # 2. Run the game.
     LOGGER.info("Running the game")
-    subprocess.run(["sudo", "xhost", "+si:localuser:gamer"])
-    process = subprocess.Popen(["sudo", "-u", "gamer", os.path.join(directory, command)], env=dict(os.environ, DISPLAY=":0", XAUTHORITY="/home/gamer/.Xauthority"))
+    _grant_x_access()
+    process = subprocess.Popen([SUDO, "-u", "gamer", os.path.join(directory, command)], env=_get_game_env())
+
+    # 3. Install a signal to kill it on hotkey Start + Select (hold both 3 seconds).
+    def terminate():
+        process.kill()
 
+    stop_hotkey = do_on_hotkey(process, terminate)
+
+    # 4. When the game process ends, clean everything up.
     def _func():
-        process.wait()
+        stop_hotkey.set()
         # Clear cron entries, at entries, and any remaining process.
         LOGGER.info("Clearing any potential crontab/atrm entry, and killing dangling processes")
-        os.system(f"crontab -u gamer -r")
-        os.system(f"atrm -u gamer")
-        os.system(f"pkill -9 -u gamer")
+        cleanups = []
+        for command in CLEANUP_COMMANDS:
+            try:
+                cleanups.append(subprocess.Popen(command))
+            except OSError:
+                LOGGER.exception(f"Could not run: {command[0]}")
+        _kill_user_processes("gamer")
+        for cleanup in cleanups:
+            cleanup.wait()
         # Save whatever game state remains.
         LOGGER.info("Storing save directory")
         store_dragonshark_save(package, app)
         on_end()
-    threading.Thread(target=_func).start()
-
-    # 3. Wait until the game process ends:
-    # Also install a signal to kill it on hotkey Start + Select (hold both 3 seconds).
-    def check():
-        return process.poll() is None
-
-    def terminate():
-        process.kill()
-
-    do_on_hotkey(check, terminate)
+    on_exit(process, _func)
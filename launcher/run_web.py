@@ -1,19 +1,29 @@
 import os
 import json
+import shutil
+import signal
 import logging
 import threading
 import subprocess
-from http.server import HTTPServer
+from http.server import ThreadingHTTPServer
 from typing import Callable, Tuple
 from .hotkeys import do_on_hotkey
+from .reaper import on_exit
 from .saves import get_dragonshark_game_save_path
 from .static_server import GzipHTTPRequestHandler
+from .users import get_user_id, get_group_id
 
 
 LOGGER = logging.getLogger("launch-server:run-web")
 LOGGER.setLevel(logging.INFO)
 
 
+# The external commands are resolved once, so launching them does
+# not need to walk the PATH (which might not even be set).
+SUDO = shutil.which("sudo") or "/usr/bin/sudo"
+CHROMIUM_BROWSER = shutil.which("chromium-browser") or "/usr/bin/chromium-browser"
+
+
 # These are the arguments for the chromium process. Ideally, they
 # will do the following:
 # - Suppress any warning(s) or notifications.
@@ -22,7 +32,7 @@ LOGGER.setLevel(logging.INFO)
 # - Open the required page in kiosk mode.
 
 
-CHROMIUM_BROWSER_ARGS = ["--disk-cache-size=0", "--enable-features=FileSystemAPI",
+CHROMIUM_BROWSER_ARGS = ("--disk-cache-size=0", "--enable-features=FileSystemAPI",
                          "--disable-site-isolation-trials", "--disable-site-isolation-for-policy",
                          "--disable-features=IsolateOrigins,site-per-process,OverscrollHistoryNavigation",
                          "--disable-local-storage", "--disable-session-storage", "--disable-quota",
@@ -33,22 +43,47 @@ CHROMIUM_BROWSER_ARGS = ["--disk-cache-size=0", "--enable-features=FileSystemAPI
                          "--site-per-process", "--site-storage-quota-policy=per_host", "--per-process-gpu",
                          "--kiosk", "--enable-fullscreen", "--activate-on-launch", "--noerrdialogs",
                          "--disable-pinch", "--start-maximized", "--disable-infobars", "--disable-notifications",
-                         "--disable-session-crashed-bubble", "--no-first-run", "--enable-offline-auto-reload",
+                         "--disable-session-crashed-bubble", "--enable-offline-auto-reload",
                          "--autoplay-policy=no-user-gesture-required", "--deny-permission-prompts",
                          "--disable-search-geolocation-disclosure", "--enable-ipv6",
-                         "--simulate-outdated-no-au='Tue, 31 Dec 2099 23:59:59 GMT'"]
+                         "--simulate-outdated-no-au=Tue, 31 Dec 2099 23:59:59 GMT")
+
+
+class _GameHTTPServer(ThreadingHTTPServer):
+    """
+    The local http server for the web games. It is started only once,
+    and then each game just sets the directory to serve. While no game
+    is running, the directory is None and no request is attended.
+    """
+
+    allow_reuse_port = True
+    directory = None
+
+    def finish_request(self, request, client_address):
+        directory = self.directory
+        if directory is not None:
+            self.RequestHandlerClass(request, client_address, self, directory=directory)
+
 
+_HTTP_SERVER = None
+_HTTP_SERVER_LOCK = threading.Lock()
 
-def _start_http_server(directory: str, command: str) -> Tuple[str, HTTPServer]:
+
+def _start_http_server(directory: str, command: str) -> Tuple[str, _GameHTTPServer]:
     """
-    Runs the server in a separate thread.
+    Serves the game directory. The server is started only once, in a
+    separate (daemon) thread, and only bound to the loopback interface,
+    since only the local browser will hit it.
     """
 
-    httpd = HTTPServer(("0.0.0.0", 8888), lambda *args, **kwargs: GzipHTTPRequestHandler(
-        *args, directory=directory, **kwargs
-    ))
-    threading.Thread(target=httpd.serve_forever).start()
-    return f"http://localhost:8888/{command}", httpd
+    global _HTTP_SERVER
+
+    with _HTTP_SERVER_LOCK:
+        if _HTTP_SERVER is None:
+            _HTTP_SERVER = _GameHTTPServer(("127.0.0.1", 8888), GzipHTTPRequestHandler)
+            threading.Thread(target=_HTTP_SERVER.serve_forever, daemon=True).start()
+    _HTTP_SERVER.directory = directory
+    return f"http://localhost:8888/{command}", _HTTP_SERVER
 
 
 def _prepare_save_size_preference(save_directory: str):
@@ -60,9 +95,9 @@ def _prepare_save_size_preference(save_directory: str):
 
     prefs_file = os.path.join(save_directory, "preferences.json")
     os.makedirs(save_directory, mode=0o700, exist_ok=True)
-    os.system("chown pi:pi " + save_directory)
-    with open(prefs_file, "w") as f:
-        json.dump({"SiteStorage": {"localhost:8888": 10485760, "*": 0}}, f)
+    os.chown(save_directory, get_user_id("pi"), get_group_id("pi"))
+    with open(prefs_file, "wb") as f:
+        f.write(json.dumps({"SiteStorage": {"localhost:8888": 10485760, "*": 0}}).encode("utf-8"))
     return prefs_file
 
 
@@ -71,17 +106,18 @@ def _run_browser(save_directory: str, prefs_file: str, url: str):
     Runs the browser game. This is done in the "pi" context, with the
     given preferences file, and with a lot of custom browser settings
     that convert the experience to a non-browser-seeming game hitting
-    the game url.
+    the game url. The browser runs in its own session (and process
+    group), so it can be terminated as a whole.
     :param save_directory: The save directory.
     :param prefs_file: The preferences file.
     :param url: The URL.
     :return: The game's browser process.
     """
 
-    sudo = "DISPLAY=:0 sudo -u pi"
-    custom = [f"--user-data-dir={save_directory}", f"--user-preferences-file={prefs_file}"]
-    chromium_command = sudo + ' ' + ' '.join(["chromium-browser"] + custom + CHROMIUM_BROWSER_ARGS + [url])
-    return subprocess.Popen(chromium_command, shell=True)
+    chromium_command = [SUDO, "-u", "pi", CHROMIUM_BROWSER,
+                        f"--user-data-dir={save_directory}", f"--user-preferences-file={prefs_file}",
+                        *CHROMIUM_BROWSER_ARGS, url]
+    return subprocess.Popen(chromium_command, env=dict(os.environ, DISPLAY=":0"), start_new_session=True)
 
 
 def run_game(directory: str, command: str, package: str, app: str, on_end: Callable[[], None]):
@@ -112,19 +148,19 @@ def run_game(directory: str, command: str, package: str, app: str, on_end: Calla
     LOGGER.info("Running the game")
     process = _run_browser(save_directory, prefs_file, url)
 
-    def _func():
-        process.wait()
-        LOGGER.info("Killing local http server")
-        web_server.shutdown()
-        on_end()
-    threading.Thread(target=_func).start()
-
-    # 4. Wait for the process and, when done, invoke the callback.
-    #    Also install a signal to kill it on hotkey Start + Select (hold both 3 seconds).
-    def check():
-        return process.poll() is None
-
+    # 4. Install a signal to kill it on hotkey Start + Select (hold both 3 seconds).
     def terminate():
-        os.system("pkill chromium")
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    stop_hotkey = do_on_hotkey(process, terminate)
 
-    do_on_hotkey(check, terminate)
+    # 5. When the process ends, invoke the callback.
+    def _func():
+        stop_hotkey.set()
+        LOGGER.info("Detaching the game from the local http server")
+        web_server.directory = None
+        on_end()
+    on_exit(process, _func)
@@ -1,4 +1,14 @@
 import os
+import errno
+import shutil
+import logging
+import tempfile
+from .users import get_user_id, get_group_id
+
+
+LOGGER = logging.getLogger("launch-server:saves")
+LOGGER.setLevel(logging.INFO)
+
 
 # This is the partition where all the Dragonshark saves exist.
 # This partition is ext4 and everything there will be owned by
@@ -44,6 +54,147 @@ def get_dragonshark_game_save_path(package_base: str, app: str):
     return f"{DRAGONSHARK_SAVES_LOCATION}/{package_base}/{app}"
 
 
+# These errors tell that a kernel-side copy is not supported for a
+# given pair of files (or at all), so another method must be used.
+_UNSUPPORTED_COPY_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP)
+_COPY_CHUNK_SIZE = 1 << 30
+_READ_CHUNK_SIZE = 1 << 16
+
+
+def _copy_file(source_path: str, target_path: str, uid: int, gid: int):
+    """
+    Copies the contents of a file into a new file, which is created
+    with the given owner and 0700 permissions. The copy is done by the
+    kernel (copy_file_range, or sendfile) whenever possible, with no
+    userspace buffers. Symbolic links are never followed.
+    :param source_path: The source file.
+    :param target_path: The target file.
+    :param uid: The new file's owner user id.
+    :param gid: The new file's owner group id.
+    """
+
+    source_fd = os.open(source_path, os.O_RDONLY | os.O_CLOEXEC | os.O_NOFOLLOW)
+    try:
+        target_fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC | os.O_NOFOLLOW, 0o700)
+        try:
+            os.fchown(target_fd, uid, gid)
+            # Both methods keep the current offsets up to date, so
+            # a method can take over where the previous one failed.
+            for method in (_copy_file_range_chunk, _sendfile_chunk):
+                try:
+                    while method(source_fd, target_fd):
+                        pass
+                    return
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_COPY_ERRORS:
+                        raise
+
+            while True:
+                chunk = os.read(source_fd, _READ_CHUNK_SIZE)
+                if not chunk:
+                    return
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(target_fd, view):]
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+
+
+def _copy_file_range_chunk(source_fd: int, target_fd: int):
+    """
+    Copies a chunk of a file using copy_file_range.
+    :return: The number of copied bytes (0 at the end of the file).
+    """
+
+    return os.copy_file_range(source_fd, target_fd, _COPY_CHUNK_SIZE)
+
+
+def _sendfile_chunk(source_fd: int, target_fd: int):
+    """
+    Copies a chunk of a file using sendfile.
+    :return: The number of copied bytes (0 at the end of the file).
+    """
+
+    return os.sendfile(target_fd, source_fd, None, _COPY_CHUNK_SIZE)
+
+
+def _copy_tree_contents(source: str, target: str, uid: int, gid: int):
+    """
+    Copies the contents of a directory into another existing directory,
+    like `cp -r {source}/* {target}` would do, but without spawning any
+    process. Symbolic links are copied as such (i.e. not followed),
+    while special files (e.g. FIFOs or devices) are skipped. The target
+    directory and everything copied into it get the given owner and
+    0700 permissions (like `chown -R` and `chmod -R` would do) as they
+    are created, instead of in another pass.
+    :param source: The source directory.
+    :param target: The target directory.
+    :param uid: The owner user id.
+    :param gid: The owner group id.
+    :return: Whether there was anything to copy.
+    """
+
+    if not os.path.isdir(source):
+        return False
+
+    os.chown(target, uid, gid)
+    os.chmod(target, 0o700)
+
+    # The tree is walked with scandir, so the entry types come from
+    # the directory listing itself, instead of a stat call per entry.
+    copied = False
+    pending = [(source, target)]
+    while pending:
+        source_directory, target_directory = pending.pop()
+        with os.scandir(source_directory) as entries:
+            for entry in entries:
+                target_path = os.path.join(target_directory, entry.name)
+                copied = True
+                if entry.is_dir(follow_symlinks=False):
+                    # Never write through an existing symbolic link in
+                    # the target (it might have been planted there).
+                    if os.path.islink(target_path):
+                        os.unlink(target_path)
+                    try:
+                        os.mkdir(target_path, 0o700)
+                    except FileExistsError:
+                        os.chmod(target_path, 0o700)
+                    os.chown(target_path, uid, gid)
+                    pending.append((entry.path, target_path))
+                    continue
+
+                # Never write through an existing entry in the target. It
+                # is just unlinked, rather than checking whether it exists.
+                try:
+                    os.unlink(target_path)
+                except FileNotFoundError:
+                    pass
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), target_path)
+                    os.chown(target_path, uid, gid, follow_symlinks=False)
+                elif entry.is_file(follow_symlinks=False):
+                    _copy_file(entry.path, target_path, uid, gid)
+    return copied
+
+
+def _clear_directory(path: str):
+    """
+    Removes everything inside a directory (but not the directory itself),
+    like `rm -rf {path}/*` would do (including hidden entries), without
+    spawning any process.
+    :param path: The directory to clear.
+    """
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+
 def store_dragonshark_save(package_base: str, app: str):
     """
     Stores a save from a game, if available. This implies copying
@@ -55,27 +206,31 @@ def store_dragonshark_save(package_base: str, app: str):
 
     source = CURRENT_SAVE_LOCATION
     target = get_dragonshark_game_save_path(package_base, app)
-    instructions = [
-        # Remember that these all instructions will be executed by root,
-        # actually (the service itself, which runs root, will be calling
-        # this function).
-
-        # First, copy the save, if any, into the SAVES_DISK/~tmp directory.
-        # If these operations (actually: the second one) cannot be performed,
-        # then this stops here: there's nothing to save.
-        f"mkdir -p {SAVES_DISK}/~tmp",
-        f"cp -r {source}/* {SAVES_DISK}/~tmp",
-        # Then, remove any previous target directory and move SAVES_DISK/~tmp
-        # to this target directory.
-        f"mkdir -p {target}",
-        f"rm -rf {target}",
-        f"mv {SAVES_DISK}/~tmp {target}",
-        # Finally, make a chown to pi:pi of all the new  files (since they'll
-        # be root:root now) and a chmod to 0700.
-        f"chown -R pi:pi {target}",
-        f"chmod -R 0700 {target}"
-    ]
-    os.system(' && '.join(instructions))
+
+    # Remember that these all operations will be executed by root,
+    # actually (the service itself, which runs root, will be calling
+    # this function).
+
+    # First, copy the save, if any, into a new SAVES_DISK/~tmp* directory.
+    # Everything is owned by pi:pi with permissions 0700 (instead of being
+    # root:root). If these operations cannot be performed, or there is
+    # nothing to copy, then this stops here: there's nothing to save.
+    temporary = None
+    try:
+        temporary = tempfile.mkdtemp(prefix="~tmp", dir=SAVES_DISK)
+        if not _copy_tree_contents(source, temporary, get_user_id("pi"), get_group_id("pi")):
+            shutil.rmtree(temporary, ignore_errors=True)
+            return
+        # Then, remove any previous target directory and rename the
+        # temporary directory to this target directory.
+        shutil.rmtree(target, ignore_errors=True)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.rename(temporary, target)
+    except (OSError, KeyError):
+        LOGGER.exception(f"Could not store the save from {source}")
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
+        return
 
 
 def load_dragonshark_save(package_base: str, app: str):
@@ -91,18 +246,20 @@ def load_dragonshark_save(package_base: str, app: str):
     source = get_dragonshark_game_save_path(package_base, app)
     target = CURRENT_SAVE_LOCATION
     # First, clear the target directory.
-    os.system(f"rm -rf {target}/*")
-    instructions = [
-        # Remember that these all instructions will be executed by root,
-        # actually (the service itself, which runs root, will be calling
-        # this function).
-
-        # First, copy the save contents from the source into the target.
-        # If this fails, then there's nothing else to do.
-        f"cp -r {source}/* {target}",
-        # Then, chown and chmod everything so "gamer" user can take it.
-        # At most 15mb can be moved this way.
-        f"chown -R pi:gamer {target}",
-        f"chmod -R 0700 {target}"
-    ]
-    os.system(' && '.join(instructions))
+    try:
+        _clear_directory(target)
+    except OSError:
+        LOGGER.exception(f"Could not clear {target}")
+
+    # Remember that these all operations will be executed by root,
+    # actually (the service itself, which runs root, will be calling
+    # this function).
+
+    # Then, copy the save contents from the source into the target. Everything
+    # is owned by pi:gamer with permissions 0700 so "gamer" user can take it.
+    # At most 15mb can be moved this way.
+    try:
+        _copy_tree_contents(source, target, get_user_id("pi"), get_group_id("gamer"))
+    except (OSError, KeyError):
+        LOGGER.exception(f"Could not copy the save from {source}")
+
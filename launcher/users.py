@@ -0,0 +1,30 @@
+import grp
+import pwd
+from functools import lru_cache
+
+
+# The users and groups involved here (e.g. "gamer", "pi" and
+# "hawalnch") never change while the launcher runs, so their
+# ids are looked up (through NSS) only once.
+
+
+@lru_cache(maxsize=16)
+def get_user_id(username: str) -> int:
+    """
+    Gets the id of a user.
+    :param username: The user name.
+    :return: The user id.
+    """
+
+    return pwd.getpwnam(username).pw_uid
+
+
+@lru_cache(maxsize=16)
+def get_group_id(group_name: str) -> int:
+    """
+    Gets the id of a group.
+    :param group_name: The group name.
+    :return: The group id.
+    """
+
+    return grp.getgrnam(group_name).gr_gid